@@ -1,5 +1,5 @@
 from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
@@ -7,13 +7,19 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Any
+from typing import List, Any, BinaryIO, Iterator
 import uuid
 from datetime import datetime, timezone
-import pdfplumber
+import pymupdf
 from openpyxl import Workbook
-import aiofiles
-import json
+import orjson
+import asyncio
+import time
+import hashlib
+import mmap
+import multiprocessing
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -22,15 +28,39 @@ load_dotenv(ROOT_DIR / '.env')
 UPLOAD_DIR = ROOT_DIR / "uploads"
 OUTPUT_DIR = ROOT_DIR / "outputs"
 DATA_DIR = ROOT_DIR / "data"
+# HASH_DIR/<sha256> lists the ids of all records for that PDF content
+HASH_DIR = DATA_DIR / "sha256"
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 DATA_DIR.mkdir(exist_ok=True)
+HASH_DIR.mkdir(exist_ok=True)
 
 # Frontend build path
 FRONTEND_DIR = ROOT_DIR.parent / "frontend" / "build"
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the parsing pool, record writer and file collector with the app"""
+    # Worker processes for CPU-bound PDF parsing. Workers start lazily while
+    # the server already runs threads, so they must not be forked from it.
+    # Created here rather than at import so workers importing this module
+    # do not each build a pool of their own.
+    app.state.executor = ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("forkserver")
+    )
+    app.state.record_queue = asyncio.Queue()
+    app.state.record_writer = asyncio.create_task(write_records())
+    app.state.gc_task = asyncio.create_task(run_garbage_collector())
+    try:
+        yield
+    finally:
+        app.state.record_writer.cancel()
+        app.state.gc_task.cancel()
+        app.state.executor.shutdown(wait=False, cancel_futures=True)
+
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -47,126 +77,293 @@ class PreviewResponse(BaseModel):
 # Max file size: 10MB
 MAX_FILE_SIZE = 10 * 1024 * 1024
 
-def extract_tables_from_pdf(pdf_path: str) -> tuple[List[List[Any]], int, int]:
-    """Extract all tables from a PDF file"""
+# PDF header, which readers accept anywhere in the first 1024 bytes
+PDF_MAGIC = b"%PDF-"
+PDF_MAGIC_WINDOW = 1024
+
+# Uploads are copied to disk in 1MB chunks
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Number of rows returned and stored for preview
+PREVIEW_ROWS = 100
+
+# Pages parsed per worker task; smaller PDFs are parsed in a single task
+PAGES_PER_TASK = 8
+
+# Generated XLSX files are cached in OUTPUT_DIR for 1 hour after last use
+XLSX_CACHE_TTL = 60 * 60
+XLSX_LOCKS: dict[str, asyncio.Lock] = {}
+XLSX_LOCK_USERS: dict[str, int] = {}
+
+# Size cap for each of UPLOAD_DIR and OUTPUT_DIR, enforced every GC_INTERVAL seconds
+MAX_DIR_BYTES = int(os.environ.get('MAX_DIR_BYTES', 1024 * 1024 * 1024))
+GC_INTERVAL = 60
+
+# Default column width for generated sheets
+XLSX_COLUMN_WIDTH = 18
+
+# Max records written per batch by the record writer
+RECORD_BATCH_SIZE = 32
+
+def clean_cell(cell: str | None) -> str:
+    """Strip a table cell, mapping None to an empty string"""
+    return cell.strip() if cell else ""
+
+@contextmanager
+def open_pdf(pdf_path: str) -> Iterator[pymupdf.Document]:
+    """Open a PDF file through a read-only mmap instead of buffered reads"""
+    with open(pdf_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            memoryview(mm) as view, \
+            pymupdf.open(stream=view, filetype="pdf") as doc:
+        yield doc
+
+def count_pdf_pages(pdf_path: str) -> int:
+    """Count the pages of a PDF file"""
+    with open_pdf(pdf_path) as doc:
+        return doc.page_count
+
+def extract_tables_from_pdf(pdf_path: str, start: int, stop: int) -> List[List[Any]]:
+    """Extract all tables from pages [start, stop) of a PDF file"""
     all_rows = []
-    total_pages = 0
     
-    with pdfplumber.open(pdf_path) as pdf:
-        total_pages = len(pdf.pages)
-        
-        for page in pdf.pages:
-            tables = page.extract_tables()
+    with open_pdf(pdf_path) as doc:
+        for page in doc.pages(start, stop):
+            tabs = page.find_tables()
             
-            if tables:
-                for table in tables:
-                    for row in table:
-                        cleaned_row = [
-                            str(cell).strip() if cell is not None else ""
-                            for cell in row
-                        ]
-                        all_rows.append(cleaned_row)
+            if tabs.tables:
+                for table in tabs:
+                    all_rows.extend(list(map(clean_cell, row)) for row in table.extract())
             else:
-                text = page.extract_text()
-                if text:
-                    lines = text.strip().split('\n')
-                    for line in lines:
-                        if line.strip():
-                            all_rows.append([line.strip()])
+                for line in page.get_text("text").splitlines():
+                    line = line.strip()
+                    if line:
+                        all_rows.append([line])
+    
+    return all_rows
+
+async def parse_pdf(pdf_path: str) -> tuple[List[List[Any]], int, int]:
+    """Extract all tables from a PDF file, spreading page ranges across worker processes"""
+    loop = asyncio.get_running_loop()
+    # MuPDF is not thread-safe, so even the page count runs in a worker process
+    total_pages = await loop.run_in_executor(app.state.executor, count_pdf_pages, pdf_path)
+    
+    parts = await asyncio.gather(*(
+        loop.run_in_executor(
+            app.state.executor, extract_tables_from_pdf, pdf_path, start, min(start + PAGES_PER_TASK, total_pages)
+        )
+        for start in range(0, total_pages, PAGES_PER_TASK)
+    ))
+    all_rows = [row for part in parts for row in part]
     
     return all_rows, len(all_rows), total_pages
 
 def create_xlsx_from_data(data: List[List[Any]], output_path: str) -> None:
     """Create an XLSX file from extracted data"""
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Converted Data"
-    
-    for row_idx, row in enumerate(data, 1):
-        for col_idx, cell_value in enumerate(row, 1):
-            ws.cell(row=row_idx, column=col_idx, value=cell_value)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Converted Data")
+    ws.sheet_format.defaultColWidth = XLSX_COLUMN_WIDTH
     
-    for column_cells in ws.columns:
-        max_length = 0
-        column = column_cells[0].column_letter
-        for cell in column_cells:
-            try:
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        ws.column_dimensions[column].width = adjusted_width
+    for row in data:
+        ws.append(row)
     
     wb.save(output_path)
 
+@asynccontextmanager
+async def xlsx_build_lock(file_id: str):
+    """Hold the per-file XLSX build lock, dropping it once nobody needs it"""
+    lock = XLSX_LOCKS.setdefault(file_id, asyncio.Lock())
+    XLSX_LOCK_USERS[file_id] = XLSX_LOCK_USERS.get(file_id, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        XLSX_LOCK_USERS[file_id] -= 1
+        if not XLSX_LOCK_USERS[file_id]:
+            del XLSX_LOCK_USERS[file_id]
+            del XLSX_LOCKS[file_id]
+
+def preview_response(record: dict) -> ORJSONResponse:
+    """Serialize a record as a PreviewResponse without revalidating it"""
+    return ORJSONResponse({
+        "id": record['id'],
+        "original_filename": record['original_filename'],
+        "status": record['status'],
+        "preview_data": record.get('preview_data', [])[:PREVIEW_ROWS],
+        "total_rows": record['total_rows'],
+        "total_pages": record['total_pages']
+    })
+
 def save_record(file_id: str, data: dict):
     """Save record to JSON file"""
     file_path = DATA_DIR / f"{file_id}.json"
-    with open(file_path, 'w') as f:
-        json.dump(data, f)
+    file_path.write_bytes(orjson.dumps(data))
+    if 'sha256' in data:
+        with open(HASH_DIR / data['sha256'], 'a') as f:
+            f.write(f"{file_id}\n")
+
+def save_records(records: List[tuple[str, dict]]):
+    """Save a batch of records to JSON files"""
+    for file_id, data in records:
+        save_record(file_id, data)
+
+async def write_records():
+    """Drain queued records and write each batch in a single thread hop"""
+    queue = app.state.record_queue
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < RECORD_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        
+        try:
+            await asyncio.to_thread(save_records, [(file_id, data) for file_id, data, _ in batch])
+        except Exception as e:
+            for _, _, done in batch:
+                if not done.cancelled():
+                    done.set_exception(e)
+        else:
+            for _, _, done in batch:
+                if not done.cancelled():
+                    done.set_result(None)
+
+async def queue_record(file_id: str, data: dict):
+    """Queue a record for the batch writer and wait until it is saved"""
+    done = asyncio.get_running_loop().create_future()
+    await app.state.record_queue.put((file_id, data, done))
+    await done
 
 def load_record(file_id: str) -> dict:
     """Load record from JSON file"""
     file_path = DATA_DIR / f"{file_id}.json"
-    if not file_path.exists():
+    try:
+        return orjson.loads(file_path.read_bytes())
+    except FileNotFoundError:
         return None
-    with open(file_path, 'r') as f:
-        return json.load(f)
+
+def read_hash_index(digest: str) -> List[str]:
+    """List the ids of every record of a PDF with this SHA-256, oldest first"""
+    try:
+        return (HASH_DIR / digest).read_text().split()
+    except FileNotFoundError:
+        return []
+
+def find_record_by_hash(digest: str) -> dict:
+    """Find the newest surviving record of a previously uploaded PDF by its SHA-256"""
+    for file_id in reversed(read_hash_index(digest)):
+        record = load_record(file_id)
+        if record and (UPLOAD_DIR / f"{file_id}.pdf").exists():
+            return record
+    return None
 
 def delete_record(file_id: str):
     """Delete record JSON file"""
-    file_path = DATA_DIR / f"{file_id}.json"
-    if file_path.exists():
-        file_path.unlink()
+    # The record may be deleted concurrently by the API and the collector
+    record = load_record(file_id)
+    if record is None:
+        return
+    if 'sha256' in record:
+        # Keep the index while other duplicates of the same PDF survive
+        file_ids = read_hash_index(record['sha256'])
+        if file_id in file_ids:
+            file_ids.remove(file_id)
+            index_path = HASH_DIR / record['sha256']
+            if file_ids:
+                index_path.write_text("".join(f"{i}\n" for i in file_ids))
+            else:
+                index_path.unlink(missing_ok=True)
+    (DATA_DIR / f"{file_id}.json").unlink(missing_ok=True)
+
+def touch_file(path: Path):
+    """Mark a file as recently used for the size-capped collector"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+def share_files(source_id: str, file_id: str):
+    """Hardlink the PDF and cached XLSX of source_id under file_id"""
+    for path in (UPLOAD_DIR / f"{source_id}.pdf", OUTPUT_DIR / f"{source_id}.xlsx"):
+        tmp_path = path.parent / f"{file_id}.{os.getpid()}.tmp"
+        try:
+            os.link(path, tmp_path)
+            os.replace(tmp_path, path.with_stem(file_id))
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+
+def save_upload(source: BinaryIO, pdf_path: Path) -> str:
+    """Copy an uploaded file object to disk, returning its SHA-256"""
+    digest = hashlib.sha256()
+    with open(pdf_path, 'wb') as f:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
 
 @api_router.get("/")
 async def root():
     return {"message": "PDF to XLSX Converter API"}
 
-@api_router.post("/upload", response_model=PreviewResponse)
+@api_router.post("/upload", responses={200: {"model": PreviewResponse}})
 async def upload_pdf(file: UploadFile = File(...)):
     """Upload a PDF file and get preview data"""
     
-    if not file.filename.lower().endswith('.pdf'):
+    name = file.filename
+    if not (name and name[-4:].lower() == '.pdf'):
         raise HTTPException(status_code=400, detail="Solo se permiten archivos PDF")
     
-    content = await file.read()
-    if len(content) > MAX_FILE_SIZE:
+    # Starlette has already spooled the whole body by now and records its size
+    if file.size > MAX_FILE_SIZE:
         raise HTTPException(status_code=400, detail="El archivo excede el límite de 10MB")
     
+    # Reject non-PDF payloads before writing anything to disk
+    if PDF_MAGIC not in await file.read(PDF_MAGIC_WINDOW):
+        raise HTTPException(status_code=400, detail="El archivo no es un PDF válido")
+    
     file_id = str(uuid.uuid4())
     
     pdf_path = UPLOAD_DIR / f"{file_id}.pdf"
-    async with aiofiles.open(pdf_path, 'wb') as f:
-        await f.write(content)
+    # Copy the spooled body to disk in a single thread hop
+    await file.seek(0)
+    sha256 = await asyncio.to_thread(save_upload, file.file, pdf_path)
     
     try:
-        data, total_rows, total_pages = extract_tables_from_pdf(str(pdf_path))
+        # Identical PDFs reuse the existing conversion instead of being parsed
+        # again, but each upload still gets its own id and filename
+        existing = await asyncio.to_thread(find_record_by_hash, sha256)
+        if existing:
+            await asyncio.to_thread(share_files, existing['id'], file_id)
+            touch_file(UPLOAD_DIR / f"{existing['id']}.pdf")
+            record = {
+                "id": file_id,
+                "original_filename": file.filename,
+                "status": "ready",
+                "preview_data": existing['preview_data'],
+                "total_rows": existing['total_rows'],
+                "total_pages": existing['total_pages'],
+                "sha256": sha256
+            }
+            await queue_record(file_id, record)
+            return preview_response(record)
+        
+        data, total_rows, total_pages = await parse_pdf(str(pdf_path))
         
         if not data:
             raise HTTPException(status_code=400, detail="No se encontraron datos en el PDF")
         
-        preview_data = data[:100]
+        preview_data = data[:PREVIEW_ROWS]
         
         record = {
             "id": file_id,
             "original_filename": file.filename,
             "status": "ready",
-            "preview_data": data,
+            "preview_data": preview_data,
             "total_rows": total_rows,
-            "total_pages": total_pages
+            "total_pages": total_pages,
+            "sha256": sha256
         }
-        save_record(file_id, record)
+        await queue_record(file_id, record)
         
-        return PreviewResponse(
-            id=file_id,
-            original_filename=file.filename,
-            status="ready",
-            preview_data=preview_data,
-            total_rows=total_rows,
-            total_pages=total_pages
-        )
+        return preview_response(record)
         
     except HTTPException:
         raise
@@ -174,7 +371,7 @@ async def upload_pdf(file: UploadFile = File(...)):
         logging.error(f"Error processing PDF: {e}")
         raise HTTPException(status_code=500, detail=f"Error procesando el PDF: {str(e)}")
 
-@api_router.get("/preview/{file_id}", response_model=PreviewResponse)
+@api_router.get("/preview/{file_id}", responses={200: {"model": PreviewResponse}})
 async def get_preview(file_id: str):
     """Get preview data for a previously uploaded file"""
     
@@ -182,16 +379,8 @@ async def get_preview(file_id: str):
     if not record:
         raise HTTPException(status_code=404, detail="Archivo no encontrado")
     
-    preview_data = record.get('preview_data', [])[:100]
-    
-    return PreviewResponse(
-        id=record['id'],
-        original_filename=record['original_filename'],
-        status=record['status'],
-        preview_data=preview_data,
-        total_rows=record['total_rows'],
-        total_pages=record['total_pages']
-    )
+    touch_file(UPLOAD_DIR / f"{file_id}.pdf")
+    return preview_response(record)
 
 @api_router.get("/download/{file_id}")
 async def download_xlsx(file_id: str):
@@ -201,24 +390,46 @@ async def download_xlsx(file_id: str):
     if not record:
         raise HTTPException(status_code=404, detail="Archivo no encontrado")
     
-    data = record.get('preview_data', [])
-    if not data:
-        raise HTTPException(status_code=400, detail="No hay datos para convertir")
-    
     xlsx_filename = record['original_filename'].rsplit('.', 1)[0] + '.xlsx'
     xlsx_path = OUTPUT_DIR / f"{file_id}.xlsx"
     
-    try:
-        create_xlsx_from_data(data, str(xlsx_path))
-        
-        return FileResponse(
-            path=str(xlsx_path),
-            filename=xlsx_filename,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-    except Exception as e:
-        logging.error(f"Error creating XLSX: {e}")
-        raise HTTPException(status_code=500, detail=f"Error creando el archivo Excel: {str(e)}")
+    if not xlsx_path.exists():
+        try:
+            async with xlsx_build_lock(file_id):
+                # Another request may have built it while we waited
+                if not xlsx_path.exists():
+                    # Only the preview is stored, so rebuild from the original PDF
+                    pdf_path = UPLOAD_DIR / f"{file_id}.pdf"
+                    if not pdf_path.exists():
+                        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+                    
+                    data, _, _ = await parse_pdf(str(pdf_path))
+                    if not data:
+                        raise HTTPException(status_code=400, detail="No hay datos para convertir")
+                    
+                    # Write to a temp file so a half-written XLSX is never served
+                    tmp_path = OUTPUT_DIR / f"{file_id}.{os.getpid()}.tmp"
+                    try:
+                        await asyncio.to_thread(create_xlsx_from_data, data, str(tmp_path))
+                        os.replace(tmp_path, xlsx_path)
+                    finally:
+                        # Only left behind when the build or rename failed
+                        tmp_path.unlink(missing_ok=True)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logging.error(f"Error creating XLSX: {e}")
+            raise HTTPException(status_code=500, detail=f"Error creando el archivo Excel: {str(e)}")
+    
+    touch_file(UPLOAD_DIR / f"{file_id}.pdf")
+    touch_file(xlsx_path)
+    
+    # Stream the cached file from disk; repeat downloads hit the page cache
+    return FileResponse(
+        path=str(xlsx_path),
+        filename=xlsx_filename,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
 
 @api_router.delete("/file/{file_id}")
 async def delete_file(file_id: str):
@@ -226,13 +437,9 @@ async def delete_file(file_id: str):
     
     delete_record(file_id)
     
-    pdf_path = UPLOAD_DIR / f"{file_id}.pdf"
-    xlsx_path = OUTPUT_DIR / f"{file_id}.xlsx"
-    
-    if pdf_path.exists():
-        pdf_path.unlink()
-    if xlsx_path.exists():
-        xlsx_path.unlink()
+    # The collector may remove these concurrently
+    (UPLOAD_DIR / f"{file_id}.pdf").unlink(missing_ok=True)
+    (OUTPUT_DIR / f"{file_id}.xlsx").unlink(missing_ok=True)
     
     return {"message": "Archivo eliminado correctamente"}
 
@@ -247,6 +454,71 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def scan_dir(directory: Path) -> list[tuple[float, int, str, int]]:
+    """List (mtime, size, path, inode) for every file in a directory"""
+    files = []
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path, stat.st_ino))
+        except OSError:
+            pass
+    return files
+
+def remove_file(path: str) -> bool:
+    """Delete a file, returning whether it was removed"""
+    try:
+        os.unlink(path)
+        return True
+    except OSError as e:
+        logging.warning(f"Could not remove {path}: {e}")
+        return False
+
+def collect_garbage():
+    """Expire cached XLSX files and cap the size of UPLOAD_DIR and OUTPUT_DIR"""
+    cutoff = time.time() - XLSX_CACHE_TTL
+    
+    for directory in (OUTPUT_DIR, UPLOAD_DIR):
+        files = []
+        for mtime, size, path, inode in scan_dir(directory):
+            if directory == OUTPUT_DIR and mtime < cutoff and remove_file(path):
+                continue
+            files.append((mtime, size, path, inode))
+        
+        # Duplicate uploads are hardlinks, so count each inode's size once and
+        # only credit it back when its last link is removed
+        links: dict[int, int] = {}
+        sizes: dict[int, int] = {}
+        for _, size, _, inode in files:
+            links[inode] = links.get(inode, 0) + 1
+            sizes[inode] = size
+        total = sum(sizes.values())
+        
+        # Evict least recently used files until under the cap. Files are
+        # touched when served, and temp files belong to in-flight writes.
+        for _, size, path, inode in sorted(files):
+            if total <= MAX_DIR_BYTES:
+                break
+            if path.endswith('.tmp') or not remove_file(path):
+                continue
+            links[inode] -= 1
+            if not links[inode]:
+                total -= size
+            if directory == UPLOAD_DIR:
+                file_id = Path(path).stem
+                delete_record(file_id)
+                (OUTPUT_DIR / f"{file_id}.xlsx").unlink(missing_ok=True)
+
+async def run_garbage_collector():
+    """Run collect_garbage every GC_INTERVAL seconds"""
+    while True:
+        try:
+            await asyncio.to_thread(collect_garbage)
+        except Exception as e:
+            logging.error(f"Error collecting files: {e}")
+        await asyncio.sleep(GC_INTERVAL)
+
 # Serve static files from frontend build
 if FRONTEND_DIR.exists():
     app.mount("/static", StaticFiles(directory=FRONTEND_DIR / "static"), name="static")
@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    """Point the server's upload, output and record directories at tmp_path"""
+    for name in ("UPLOAD_DIR", "OUTPUT_DIR", "DATA_DIR", "HASH_DIR"):
+        directory = tmp_path / name.lower()
+        directory.mkdir()
+        monkeypatch.setattr(server, name, directory)
+    return tmp_path
+
+
+@pytest.fixture
+def client(dirs):
+    with TestClient(server.app) as client:
+        yield client
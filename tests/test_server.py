@@ -0,0 +1,251 @@
+import asyncio
+import os
+
+import pymupdf
+
+import pytest
+
+import server
+
+
+def upload(client, filename, content):
+    response = client.post("/api/upload", files={"file": (filename, content, "application/pdf")})
+    assert response.status_code == 200
+    return response.json()
+
+
+def make_pdf(*pages):
+    doc = pymupdf.open()
+    for text in pages:
+        doc.new_page().insert_text((72, 72), text)
+    return doc.tobytes()
+
+
+@pytest.fixture
+def pdf_bytes():
+    return make_pdf("Cliente ID: 1\nTotal: 380")
+
+
+def set_age(path, seconds):
+    past = os.stat(path).st_mtime - seconds
+    os.utime(path, (past, past))
+
+
+def test_upload_rejects_non_pdf_payload(client):
+    response = client.post("/api/upload", files={"file": ("a.pdf", b"not a pdf", "application/pdf")})
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "El archivo no es un PDF válido"
+
+
+def test_upload_accepts_header_after_leading_bytes(client, pdf_bytes):
+    result = upload(client, "a.pdf", b"\xef\xbb\xbf\r\n" + pdf_bytes)
+
+    assert result["preview_data"] == [["Cliente ID: 1"], ["Total: 380"]]
+
+
+def test_duplicate_upload_gets_own_record(client, pdf_bytes, monkeypatch):
+    first = upload(client, "a.pdf", pdf_bytes)
+
+    async def fail_parse(pdf_path):
+        raise AssertionError("duplicate upload was parsed again")
+
+    monkeypatch.setattr(server, "parse_pdf", fail_parse)
+    second = upload(client, "b.pdf", pdf_bytes)
+
+    assert second["id"] != first["id"]
+    assert second["original_filename"] == "b.pdf"
+    assert second["preview_data"] == first["preview_data"] == [["Cliente ID: 1"], ["Total: 380"]]
+    assert second["total_rows"] == first["total_rows"]
+    assert os.path.samefile(
+        server.UPLOAD_DIR / f"{first['id']}.pdf", server.UPLOAD_DIR / f"{second['id']}.pdf"
+    )
+
+
+def test_delete_keeps_duplicate_files(client, pdf_bytes):
+    first = upload(client, "a.pdf", pdf_bytes)
+    second = upload(client, "b.pdf", pdf_bytes)
+
+    assert client.delete(f"/api/file/{first['id']}").status_code == 200
+
+    assert client.get(f"/api/preview/{first['id']}").status_code == 404
+    response = client.get(f"/api/download/{second['id']}")
+    assert response.status_code == 200
+    assert 'filename="b.xlsx"' in response.headers["content-disposition"]
+
+
+def test_hash_index_survives_deleting_newest_duplicate(client, pdf_bytes, monkeypatch):
+    first = upload(client, "a.pdf", pdf_bytes)
+    second = upload(client, "b.pdf", pdf_bytes)
+    digest = server.load_record(first["id"])["sha256"]
+    assert server.read_hash_index(digest) == [first["id"], second["id"]]
+
+    # Deleting the newest duplicate must leave the older one discoverable
+    client.delete(f"/api/file/{second['id']}")
+    assert server.read_hash_index(digest) == [first["id"]]
+
+    async def fail_parse(pdf_path):
+        raise AssertionError("duplicate upload was parsed again")
+
+    monkeypatch.setattr(server, "parse_pdf", fail_parse)
+    third = upload(client, "c.pdf", pdf_bytes)
+    assert os.path.samefile(
+        server.UPLOAD_DIR / f"{first['id']}.pdf", server.UPLOAD_DIR / f"{third['id']}.pdf"
+    )
+
+    client.delete(f"/api/file/{first['id']}")
+    client.delete(f"/api/file/{third['id']}")
+    assert not (server.HASH_DIR / digest).exists()
+
+
+def test_duplicate_upload_errors_are_reported(client, pdf_bytes, monkeypatch):
+    upload(client, "a.pdf", pdf_bytes)
+
+    def fail_share(source_id, file_id):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(server, "share_files", fail_share)
+    response = client.post("/api/upload", files={"file": ("b.pdf", pdf_bytes, "application/pdf")})
+
+    assert response.status_code == 500
+    assert response.json()["detail"] == "Error procesando el PDF: disk full"
+
+
+def test_repeat_download_reuses_cached_xlsx(client, pdf_bytes, monkeypatch):
+    file_id = upload(client, "a.pdf", pdf_bytes)["id"]
+    first = client.get(f"/api/download/{file_id}")
+    assert first.status_code == 200
+
+    async def fail_parse(pdf_path):
+        raise AssertionError("cached XLSX was rebuilt")
+
+    monkeypatch.setattr(server, "parse_pdf", fail_parse)
+    second = client.get(f"/api/download/{file_id}")
+
+    assert second.status_code == 200
+    assert second.content == first.content
+
+
+def test_failed_xlsx_build_leaves_no_temp_file(client, pdf_bytes, monkeypatch):
+    file_id = upload(client, "a.pdf", pdf_bytes)["id"]
+
+    def fail_build(data, output_path):
+        with open(output_path, "wb") as f:
+            f.write(b"partial")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(server, "create_xlsx_from_data", fail_build)
+    response = client.get(f"/api/download/{file_id}")
+
+    assert response.status_code == 500
+    assert os.listdir(server.OUTPUT_DIR) == []
+
+
+def test_multi_page_pdf_is_parsed_in_page_order(client):
+    pages = [f"page {i}" for i in range(20)]
+    assert len(pages) > server.PAGES_PER_TASK
+
+    result = upload(client, "pages.pdf", make_pdf(*pages))
+
+    assert result["total_pages"] == 20
+    assert result["total_rows"] == 20
+    assert result["preview_data"] == [[text] for text in pages]
+
+
+def test_collector_evicts_least_recently_used_upload(client, monkeypatch):
+    old = upload(client, "old.pdf", make_pdf("old"))
+    new = upload(client, "new.pdf", make_pdf("new"))
+    old_pdf = server.UPLOAD_DIR / f"{old['id']}.pdf"
+    new_pdf = server.UPLOAD_DIR / f"{new['id']}.pdf"
+    set_age(old_pdf, 200)
+    set_age(new_pdf, 100)
+
+    # Downloading the older upload makes it the most recently used one
+    assert client.get(f"/api/download/{old['id']}").status_code == 200
+    (server.OUTPUT_DIR / f"{new['id']}.xlsx").write_bytes(b"stale")
+
+    monkeypatch.setattr(server, "MAX_DIR_BYTES", old_pdf.stat().st_size)
+    server.collect_garbage()
+
+    assert old_pdf.exists()
+    assert server.load_record(old["id"]) is not None
+    assert not new_pdf.exists()
+    assert server.load_record(new["id"]) is None
+    assert not (server.OUTPUT_DIR / f"{new['id']}.xlsx").exists()
+
+
+def test_collector_counts_hardlinked_uploads_once(client, pdf_bytes, monkeypatch):
+    first = upload(client, "a.pdf", pdf_bytes)
+    second = upload(client, "b.pdf", pdf_bytes)
+
+    monkeypatch.setattr(server, "MAX_DIR_BYTES", len(pdf_bytes))
+    server.collect_garbage()
+
+    assert server.load_record(first["id"]) is not None
+    assert server.load_record(second["id"]) is not None
+
+
+def test_collector_expires_cached_xlsx(dirs):
+    expired = server.OUTPUT_DIR / "expired.xlsx"
+    fresh = server.OUTPUT_DIR / "fresh.xlsx"
+    building = server.OUTPUT_DIR / "building.1.tmp"
+    for path in (expired, fresh, building):
+        path.write_bytes(b"xlsx")
+    set_age(expired, server.XLSX_CACHE_TTL + 1)
+
+    server.collect_garbage()
+
+    assert not expired.exists()
+    assert fresh.exists()
+    assert building.exists()
+
+
+def test_delete_record_of_missing_file(dirs):
+    server.delete_record("missing")
+
+
+def run_record_writer(monkeypatch, records):
+    monkeypatch.setattr(server.app.state, "record_queue", asyncio.Queue(), raising=False)
+    return asyncio.run(queue_records(records))
+
+
+async def queue_records(records):
+    writer = asyncio.create_task(server.write_records())
+    try:
+        return await asyncio.gather(
+            *(server.queue_record(file_id, data) for file_id, data in records),
+            return_exceptions=True
+        )
+    finally:
+        writer.cancel()
+
+
+def test_record_writer_saves_in_batches(dirs, monkeypatch):
+    batches = []
+    save_records = server.save_records
+
+    def track_batches(records):
+        batches.append(len(records))
+        save_records(records)
+
+    monkeypatch.setattr(server, "save_records", track_batches)
+    monkeypatch.setattr(server, "RECORD_BATCH_SIZE", 2)
+    records = [(f"id-{i}", {"id": f"id-{i}"}) for i in range(5)]
+
+    results = run_record_writer(monkeypatch, records)
+
+    assert results == [None] * 5
+    assert batches == [2, 2, 1]
+    for file_id, data in records:
+        assert server.load_record(file_id) == data
+
+
+def test_record_writer_fails_every_waiter_in_batch(dirs, monkeypatch):
+    def fail(records):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(server, "save_records", fail)
+
+    results = run_record_writer(monkeypatch, [("a", {}), ("b", {})])
+
+    assert [str(result) for result in results] == ["disk full", "disk full"]